@@ -10,10 +10,14 @@ of address pairs until it makes a successful connection.
 
 The module also provides getapr.init_getapr() which initialises
 the state information and asynchronous processes used by
-get_addr_pairs(). This initialisation will take at least
-10 seconds and includes network probes. If the user does not
-call this function, it will be called automatically by the
-first call to get_addr_pairs().
+get_addr_pairs(). Initialisation starts in the background
+as soon as the module is imported. init_getapr() waits until it
+is complete, including the first round of network probes, which
+may take several seconds. If the user does not call this
+function, the first call to get_addr_pairs() waits for the same
+thing, but for at most 15 seconds. If the initialisation failed,
+both functions try it again, and raise its exception if it fails
+again.
 
 The module also provides getapr.status() which returns a
 Python dictionary indicating the detected connectivity
@@ -92,22 +96,27 @@ may be glitches.
 
 import os
 import time
+import json
+import errno
 import socket
+import selectors
 import ipaddress
 import threading
 import subprocess
 import binascii
 import random
-import copy
+import itertools
+import functools
+import collections
 
 ####################################################
 # import Atlas probe API                           #
 ####################################################
 
 try:
-    from ripe.atlas.cousteau import Probe
+    from ripe.atlas.cousteau import ProbeRequest
 except:
-    print("Could not import Probe",
+    print("Could not import ProbeRequest",
         "\nPlease install ripe.atlas.cousteau with pip or apt-get.")
     time.sleep(10)
     exit()
@@ -137,20 +146,172 @@ if os.name!="nt":
         "\nPlease install netifaces with pip or apt-get.")
         time.sleep(10)
         exit()
+else:
+    import ctypes
+
+####################################################
+# Windows IP Helper API (GetAdaptersAddresses)     #
+####################################################
+
+#Only the leading fields of each structure that the
+#code actually reads are declared, which is safe because
+#the structures are only ever read through pointers.
+#ULONG is 32 bits on Windows.
+
+if os.name=="nt":
+    class _SOCKET_ADDRESS(ctypes.Structure):
+        _fields_ = [("lpSockaddr", ctypes.c_void_p),
+                    ("iSockaddrLength", ctypes.c_int)]
+
+    class _ADDRESS_ENTRY(ctypes.Structure):
+        """Head of IP_ADAPTER_UNICAST_ADDRESS and IP_ADAPTER_GATEWAY_ADDRESS"""
+        pass
+    _ADDRESS_ENTRY._fields_ = [("Length", ctypes.c_uint32),
+                               ("Flags", ctypes.c_uint32),
+                               ("Next", ctypes.POINTER(_ADDRESS_ENTRY)),
+                               ("Address", _SOCKET_ADDRESS)]
+
+    class _IP_ADAPTER_ADDRESSES(ctypes.Structure):
+        pass
+    _IP_ADAPTER_ADDRESSES._fields_ = [
+        ("Length", ctypes.c_uint32),
+        ("IfIndex", ctypes.c_uint32),
+        ("Next", ctypes.POINTER(_IP_ADAPTER_ADDRESSES)),
+        ("AdapterName", ctypes.c_char_p),
+        ("FirstUnicastAddress", ctypes.POINTER(_ADDRESS_ENTRY)),
+        ("FirstAnycastAddress", ctypes.c_void_p),
+        ("FirstMulticastAddress", ctypes.c_void_p),
+        ("FirstDnsServerAddress", ctypes.c_void_p),
+        ("DnsSuffix", ctypes.c_wchar_p),
+        ("Description", ctypes.c_wchar_p),
+        ("FriendlyName", ctypes.c_wchar_p),
+        ("PhysicalAddress", ctypes.c_ubyte * 8),
+        ("PhysicalAddressLength", ctypes.c_uint32),
+        ("Flags", ctypes.c_uint32),
+        ("Mtu", ctypes.c_uint32),
+        ("IfType", ctypes.c_uint32),
+        ("OperStatus", ctypes.c_int),
+        ("Ipv6IfIndex", ctypes.c_uint32),
+        ("ZoneIndices", ctypes.c_uint32 * 16),
+        ("FirstPrefix", ctypes.c_void_p),
+        ("TransmitLinkSpeed", ctypes.c_uint64),
+        ("ReceiveLinkSpeed", ctypes.c_uint64),
+        ("FirstWinsServerAddress", ctypes.c_void_p),
+        ("FirstGatewayAddress", ctypes.POINTER(_ADDRESS_ENTRY))]
+
+_GAA_FLAGS = 0x008E          #SKIP_ANYCAST|SKIP_MULTICAST|SKIP_DNS_SERVER|INCLUDE_GATEWAYS
+_ERROR_BUFFER_OVERFLOW = 111
+_ERROR_NO_DATA = 232
+_IF_OPER_STATUS_UP = 1
+
+def _sockaddr(sa):
+    """Convert SOCKET_ADDRESS to ipaddress.ip_address, or None"""
+    raw = ctypes.string_at(sa.lpSockaddr, sa.iSockaddrLength)
+    family = int.from_bytes(raw[0:2], "little")
+    if family == socket.AF_INET:
+        return _cached_ipv4(raw[4:8])
+    elif family == socket.AF_INET6:
+        a = _cached_ipv6(raw[8:24])
+        if a.is_link_local:
+            #add the interface index as the zone, as the socket API does
+            a = _cached_ipv6(str(a)+"%"+str(int.from_bytes(raw[24:28], "little")))
+        return a
+    return None
+
+def _win_addresses():
+    """Return lists of unicast addresses and gateways of all adapters that are up,
+or (None, None) if the API call failed"""
+    addrs = []
+    gateways = []
+    size = ctypes.c_ulong(15000)
+    for _i in range(3):
+        buf = ctypes.create_string_buffer(size.value)
+        ret = ctypes.windll.iphlpapi.GetAdaptersAddresses(socket.AF_UNSPEC,
+                                _GAA_FLAGS, None, buf, ctypes.byref(size))
+        if ret != _ERROR_BUFFER_OVERFLOW:
+            break   #else size now shows what is needed, so try again
+    if ret == _ERROR_NO_DATA:
+        return(addrs, gateways)     #genuinely no adapters
+    if ret:
+        #give up this time; the next refresh will try again
+        return(None, None)
+    adapter = ctypes.cast(buf, ctypes.POINTER(_IP_ADAPTER_ADDRESSES))
+    while adapter:
+        if adapter.contents.OperStatus == _IF_OPER_STATUS_UP:
+            entry = adapter.contents.FirstUnicastAddress
+            while entry:
+                _a = _sockaddr(entry.contents.Address)
+                if _a:
+                    addrs.append(_a)
+                entry = entry.contents.Next
+            entry = adapter.contents.FirstGatewayAddress
+            while entry:
+                _a = _sockaddr(entry.contents.Address)
+                if _a and not _a.is_unspecified:
+                    gateways.append(_a)
+                entry = entry.contents.Next
+        adapter = adapter.contents.Next
+    return(addrs, gateways)
         
+####################################################
+# Address properties, computed once per address    #
+####################################################
+
+#split is (address, zone) as strings if there is a zone, else None
+_AddrMeta = collections.namedtuple("_AddrMeta",
+    "addr version is_ll is_priv is_global is_ula scope_id text split")
+
+def _is_ula(a):
+    """Test for ULA (address or its string)"""
+    return str(a).startswith(('fd', 'fc'))
+
+#Parsing an address string and working out its properties are
+#both slow pure-Python code, but the same few addresses recur
+#all the time, so the results are cached. Addresses and
+#_AddrMeta are immutable, so sharing them is safe.
+
+_cached_ip = functools.lru_cache(maxsize=256)(ipaddress.ip_address)
+_cached_ipv4 = functools.lru_cache(maxsize=256)(ipaddress.IPv4Address)
+_cached_ipv6 = functools.lru_cache(maxsize=256)(ipaddress.IPv6Address)
+
+@functools.lru_cache(maxsize=256)
+def _meta(a):
+    """Return _AddrMeta for address (as ipaddress.ip_address)"""
+    text = str(a)
+    head, pct, zone = text.partition("%")
+    return _AddrMeta(a, a.version, a.is_link_local, a.is_private, a.is_global,
+                     _is_ula(text), getattr(a, "scope_id", None), text,
+                     (head, zone) if pct else None)
+
 ####################################################
 # Class to hold an address pair & telemetry data   #
 ####################################################
 
 class _addr_pair:
     """Address pair with properties"""
-    def __init__(self, sa, da, latency):
-        self.sa = sa  #source address (as ipaddress.ip_address)
-        self.da = da  #destination address (as ipaddress.ip_address)
+    __slots__ = ('sa_meta', 'da_meta', 'latency')
+    def __init__(self, sa_meta, da_meta, latency):
+        self.sa_meta = sa_meta  #source address properties (shared)
+        self.da_meta = da_meta  #destination address properties (shared)
         self.latency = latency  # latency (ms)
+    @property
+    def sa(self):
+        return self.sa_meta.addr  #source address (as ipaddress.ip_address)
+    @property
+    def da(self):
+        return self.da_meta.addr  #destination address (as ipaddress.ip_address)
     def __repr__(self):
         return repr((self.sa, self.da, self.latency))
 
+class _pool_entry:
+    """Open probe connection kept for reuse"""
+    __slots__ = ('sock', 'opened', 'last_used', 'latency')
+    def __init__(self, sock, latency):
+        self.sock = sock  #connected socket
+        self.opened = time.monotonic()  #when connected
+        self.last_used = self.opened    #when last confirmed alive
+        self.latency = latency  # latency measured when connected (ms)
+
         
 
 ####################################################
@@ -158,25 +319,65 @@ class _addr_pair:
 ####################################################
 
 _prng = random.SystemRandom()
+
+#The main lists and maps are never modified in place.
+#Readers simply use the current one, without locking.
+#Writers hold the lock, build a new one and rebind the name.
+
 _sa_list_lock = threading.Lock()
-_sa_list = []   #list of possible source addresses
+_sa_list = ()   #list of possible source addresses (as _AddrMeta)
 _da_list_lock = threading.Lock()
-_da_list = []   #list of destination addresses to test
-_pair_list_lock = threading.Lock()
-_pair_list = [] #list of successful address pairs with latency
+_da_list = {}   #destination addresses to test (as _AddrMeta) keyed by str(da),
+                #oldest first
+_pair_map_lock = threading.Lock()
+_pair_map = {}  #successful address pairs with latency, keyed by (str(sa), str(da))
+_pair_by_da = {} #lists of the same pairs, keyed by str(da)
+_conn_pool_lock = threading.Lock()
+_conn_pool = {} #open probe connections keyed by (str(sa), str(da))
+_zid_cache = {} #interface (zone) name to index, rebuilt with source list
+_gai_cache_lock = threading.Lock()
+_gai_cache = {} #recent getaddrinfo() results keyed by (target, port)
 
 _poll_count = 0 #keep track of polling
+_work_cv = threading.Condition()  #wakes _poll early
+_work_pending = False   #set (under _work_cv) when _poll should not wait
 _max_da = 10    #how big we allow the destination list to grow
+_recheck = 100  #probe an address family that never worked every this many passes
+_stack_size = 256*1024  #stack for the _poll thread (bytes)
 
 _test_done = False  #used for a one-time-through test mode
 _logging = True     #set when selective logging wanted
 _printing = False   #set if log printing wanted
 _getapr_initialised = False
+_init_lock = threading.Lock()   #serialises concurrent init_getapr() calls
+_getapr_ready = threading.Event()   #set when background initialisation is done
+_init_error = None  #exception raised by background initialisation, if any
+_first_poll_done = threading.Event() #set when _poll has completed a pass
 
 def_gateway4 = None #default gateways
 def_gateway6 = None
 
 _timeout = 5        #timeout for connect attempts (s)
+_first_wait = 15    #get_addr_pairs() waits this long at most for the first pass (s)
+_probe_mode = "connect" #"connect" times the TCP handshake,
+                        #"http" times a HEAD request after it
+#errno values showing a non-blocking connect is under way
+_in_progress = (errno.EINPROGRESS, errno.EWOULDBLOCK,
+                getattr(errno, "WSAEWOULDBLOCK", errno.EWOULDBLOCK))
+_pool_idle = 25     #reuse pooled connection only if used this recently (s)
+_pool_max_age = 60  #close pooled connection this long after opening (s)
+_gai_ttl = 60       #how long to reuse a getaddrinfo() result (s)
+_anchor_ttl = 86400 #how long to reuse the cached ATLAS anchor list (s)
+_anchor_max = 500   #how many anchors to fetch (one API page)
+#the anchor list is cached per user, never in a shared directory
+if os.name == "nt":
+    _cache_dir = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+else:
+    _cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+_anchor_cache = os.path.join(_cache_dir, "getapr", "anchors.json")
+#probe targets in case ATLAS is unavailable
+_FALLBACK_V6 = ipaddress.IPv6Address("2a00:dd80:3c::b3f") #ipv6.lookup.test-ipv6.com
+_FALLBACK_V4 = ipaddress.IPv4Address("216.218.223.250")   #ipv4.lookup.test-ipv6.com
 _latency6 = 200     #default latency for IPv6 (ms)
 _latency4 = 250     #default latency for IPv4 (ms)
     
@@ -184,6 +385,9 @@ NPTv6 = False       #NPTv6 or NAPT66 assumed absent by default
 NAT44 = False       #NAPT44 assumed absent by default
 NPTv6_tried = False #To detect first time through
 NAT44_tried = False #To detect first time through
+IPv6_tried = False  #Turns True on first untranslated IPv6 probe
+IPv4_tried = False  #Turns True on first untranslated IPv4 probe
+                    #(both reset when the sources change)
 ULA_present = False #ULA assumed absent by default
 RFC1918 = False     #RFC1918 assumed absent by default
 ULA_ok = False      #Turns True on first ULA<>ULA success
@@ -191,6 +395,10 @@ GUA_ok = False      #Turns True on first GUA<>GUA success
 LLA_ok = False      #Turns True on first LLA<>LLA success
 IPv4_ok = False     #Turns True on first IPv4<>IPv4 success
 
+#copy of the flags for status(), replaced by _publish_status()
+_status_dict = {"GUA_ok": False, "ULA_ok": False, "LLA_ok": False, "IPv4_ok": False,
+     "ULA_present": False, "NPTv6": False, "RFC1918": False, "NAT44": False}
+
 
 def _log(*whatever):
     """Print, if wanted"""
@@ -208,182 +416,361 @@ def _log(*whatever):
 
 def _log_lists():
     """Print lists, if wanted"""
+    if not _printing:
+        return      #don't walk the lists for nothing
     _log("\nSources:")
     for _a in _sa_list:
-        _log(_a)
+        _log(_a.addr)
     _log("\nDestinations:")
-    for _a in _da_list:
-        _log(_a)
+    for _a in _da_list.values():
+        _log(_a.addr)
             
 
 
-def _is_ula(a):
-    """Test for ULA"""
-    return (str(a).startswith('fd') or str(a).startswith('fc'))
+def _publish_status():
+    """Refresh the status dictionary from the flags"""
+    global _status_dict
+    _status_dict = {"GUA_ok": GUA_ok, "ULA_ok": ULA_ok, "LLA_ok": LLA_ok, "IPv4_ok": IPv4_ok,
+     "ULA_present": ULA_present, "NPTv6": NPTv6, "RFC1918": RFC1918, "NAT44": NAT44}
+
+def _zid(name):
+    """Convert interface (zone) name to numeric index"""
+    return _zid_cache.get(name) or socket.if_nametoindex(name)
+
+def _cached_getaddrinfo(target, port):
+    """socket.getaddrinfo(), remembering results for a short time"""
+    now = time.monotonic()
+    key = (target, port)
+    with _gai_cache_lock:
+        entry = _gai_cache.get(key)
+    if entry and now - entry[0] < _gai_ttl:
+        return(entry[1])
+    ainf = socket.getaddrinfo(target, port)
+    with _gai_cache_lock:
+        for k in [k for k in _gai_cache if now - _gai_cache[k][0] >= _gai_ttl]:
+            del _gai_cache[k]   #expired
+        _gai_cache[key] = (now, ainf)
+    return(ainf)
 
 def _update_sources():
     """Find current available source addresses"""
 ####################################################
 # This code is very o/s dependent
 ####################################################
-    global _sa_list, _sa_list_lock, ULA_present, RFC1918, def_gateway4, def_gateway6
-    _sa_list_lock.acquire()
-    _sa_list = []   # Empty list of source addresses
+    global _sa_list, _sa_list_lock, _zid_cache, ULA_present, RFC1918, def_gateway4, def_gateway6
+    global IPv6_tried, IPv4_tried
+    #build everything locally, and only lock to publish it
+    sa_list = []   # Empty list of source addresses
+    ula_present = False
+    rfc1918 = False
     if os.name=="nt":
-        #This only works on Windows              
-        _addrinfo = socket.getaddrinfo(socket.gethostname(),0)
-        for _af,_temp1,_temp2,_temp3,_addr in _addrinfo:
-            if _af == socket.AF_INET6:
-                _addr,_temp,_temp,_zid = _addr  #get first item from tuple
-                _loc = ipaddress.IPv6Address(_addr)
-                if _loc.is_loopback:
-                    continue
-                if (not '%' in _addr) and _loc.is_link_local:
-                    #this applies on Windows for Python 3.7 upwards
-                    _addr += "%"+str(_zid)
-                    _loc = ipaddress.IPv6Address(_addr)
+        #This only works on Windows
+        _addrs, _gateways = _win_addresses()
+        if _addrs is None:
+            return      #keep the previous sources and gateways
+        for _loc in _addrs:
+            if _loc.is_loopback:
+                continue
+            if _loc.version == 6:
                 if _is_ula(_loc):
-                    ULA_present = True
-                _sa_list.append(_loc)
-                    
-            elif _af == socket.AF_INET:
-                _addr,_temp = _addr  #get first item from tuple
-                _loc = ipaddress.IPv4Address(_addr)
-                if _loc.is_loopback:
-                    continue
-                if _loc.is_private:
-                    RFC1918 = True
-                _sa_list.append(_loc)
-        #Get default gateways
-        _ing = False
-        for l in os.popen("ipconfig"):
-            _s = str(l)
-            if _ing:
-                if _s.startswith("                                      "):
-                   def_gateway4 = ipaddress.ip_address(_s.strip())
-                _ing = False
-            elif "Default Gateway" in _s:
-                _ing = True
-                def_gateway6 = ipaddress.ip_address(_s.split(" ")[-1].strip())           
+                    ula_present = True
+            elif _loc.is_private:
+                rfc1918 = True
+            sa_list.append(_meta(_loc))
+        #Get default gateways (first one found for each version)
+        _gw4 = None
+        _gw6 = None
+        for _gw in _gateways:
+            if _gw.version == 4 and not _gw4:
+                _gw4 = _gw
+            elif _gw.version == 6 and not _gw6:
+                _gw6 = _gw
+        if _gw4:
+            def_gateway4 = _gw4
+        if _gw6:
+            def_gateway6 = _gw6
     else:
         # Assume POSIX
         ifs = netifaces.interfaces()
+        zid_cache = {}
         for interface in ifs:
-            config = netifaces.ifaddresses(interface)
+            try:
+                zid_cache[interface] = socket.if_nametoindex(interface)
+            except OSError:
+                pass    #interface just vanished
+            try:
+                config = netifaces.ifaddresses(interface)
+            except ValueError:
+                continue    #interface just vanished
             if netifaces.AF_INET6 in config.keys():
                 for link in config[netifaces.AF_INET6]:
                     if 'addr' in link.keys():
                         _addr = link['addr']
-                        _loc = ipaddress.IPv6Address(_addr)
+                        _loc = _cached_ipv6(_addr)
                         if _loc.is_loopback:
                             continue
                         if _is_ula(_loc):
-                            ULA_present = True
-                        _sa_list.append(_loc)
+                            ula_present = True
+                        sa_list.append(_meta(_loc))
             if netifaces.AF_INET in config.keys():
                 for link in config[netifaces.AF_INET]:
                     if 'addr' in link.keys():
                         _addr = link['addr']
-                        _loc = ipaddress.IPv4Address(_addr)
+                        _loc = _cached_ipv4(_addr)
                         if _loc.is_loopback:
                             continue
                         if _loc.is_private:
-                            RFC1918 = True
-                        _sa_list.append(_loc)
+                            rfc1918 = True
+                        sa_list.append(_meta(_loc))
         # Get default gateways
         gateways = netifaces.gateways()
         try:
-            def_gateway4 = ipaddress.IPv4Address(gateways['default'][netifaces.AF_INET][0])
-        except:
-            pass
+            def_gateway4 = _cached_ipv4(gateways['default'][netifaces.AF_INET][0])
+        except (KeyError, IndexError, ValueError):
+            pass    #no IPv4 default gateway
         try:
             _gwa = gateways['default'][netifaces.AF_INET6][0]
             _zid = gateways['default'][netifaces.AF_INET6][1]
-            def_gateway6 = ipaddress.IPv6Address(_gwa+"%"+_zid)        
-        except:
-            pass
+            def_gateway6 = _cached_ipv6(_gwa+"%"+_zid)        
+        except (KeyError, IndexError, ValueError):
+            pass    #no IPv6 default gateway
+        _zid_cache = zid_cache
                         
-    _sa_list_lock.release()
-
-
-def _ok(sa, da):
-    """Check address pair. Return False if bad, latency in ms if OK"""
-
-    global NPTv6, NAT44, NPTv6_tried, NAT44_tried, ULA_ok, GUA_ok, LLA_ok, IPv4_ok
+    if ula_present:
+        ULA_present = True
+    if rfc1918:
+        RFC1918 = True
+    _publish_status()
+    with _sa_list_lock:
+        if {m.text for m in sa_list} != {m.text for m in _sa_list}:
+            #sources have changed, so DNS answers may have changed too
+            with _gai_cache_lock:
+                _gai_cache.clear()
+            #and an address family that never worked may work now
+            IPv6_tried = False
+            IPv4_tried = False
+        _sa_list = tuple(sa_list)
+
+
+def _submit(sel, sa, da):
+    """Start non-blocking probe of address pair.
+Return False if bad, True if registered with selector"""
     
     if sa.version != da.version:
         return(False)   #never try NAT46 or NAT64
-    if sa.is_link_local != da.is_link_local:
+    if sa.is_ll != da.is_ll:
         return(False)   #link-locals can only talk to each other
+    sock = None
     try:
         if sa.version == 6:
-            if sa.is_link_local and sa.scope_id != da.scope_id:
+            if sa.is_ll and sa.scope_id != da.scope_id:
                 #print("!scope", sa.scope_id, da.scope_id)
                 return(False)   #different interface
+            _sa = sa.text
+            _da = da.text
             zid = 0
-            if sa.is_link_local and da.is_link_local:
+            if sa.is_ll and da.is_ll:
                 #print("!2 LLAs", sa, da)
                 #must split interface index off because Linux is fussy ... but not for Windows
                 if os.name != "nt":
-                    sa,zid = str(sa).split("%")
-                    sa = ipaddress.IPv6Address(sa)
-                    zid = socket.if_nametoindex(zid) #convert to numeric
-                    da,_ = str(da).split("%")
-                    da = ipaddress.IPv6Address(da)
-                    #print("!LLA", sa, da, zid)
+                    _sa, zid = sa.split
+                    zid = _zid(zid) #convert to numeric
+                    _da = da.split[0]
+                    #print("!LLA", _sa, _da, zid)
             
-            if _is_ula(sa) and not _is_ula(da):
+            if sa.is_ula and not da.is_ula:
                 if NPTv6_tried and not NPTv6:
                     return(False)   #ULAs can only talk to each other
-                else:
-                    NPTv6_tried = True
             sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-            sock.bind((str(sa), 0, 0, zid))
-            sock.settimeout(_timeout)
+            sock.setblocking(False)
+            sock.bind((_sa, 0, 0, zid))
             t0 = time.monotonic()
-            sock.connect((str(da), 80, 0, zid))
-            latency = max(int((time.monotonic() - t0)*1000),1)
-            if _is_ula(sa) and not _is_ula(da):
-                NPTv6 = True
-            elif _is_ula(sa) and _is_ula(da):
-                ULA_ok = True
-            elif sa.is_link_local and da.is_link_local:
-                LLA_ok = True
-            else:
-                GUA_ok = True                    
+            err = sock.connect_ex((_da, 80, 0, zid))
         else:
-            if sa.is_private and not da.is_private:
+            if sa.is_priv and not da.is_priv:
                 if NAT44_tried and not NAT44:
                     return(False)   #RFC1918s can only talk to each other
-                else:
-                    NAT44_tried = True          
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.bind((str(sa),0))
-            sock.settimeout(_timeout)
+            sock.setblocking(False)
+            sock.bind((sa.text,0))
             t0 = time.monotonic()
-            sock.connect((str(da), 80))
-            latency = max(int((time.monotonic() - t0)*1000),1)
-            IPv4_ok = True
-            if sa.is_private and not da.is_private:
+            err = sock.connect_ex((da.text, 80))
+        if err and not err in _in_progress:
+            sock.close()
+            return(False)
+        sel.register(sock, selectors.EVENT_WRITE, (sa, da, t0, False))
+    except Exception as ex:
+        #print("!connect", ex, sa.text, da.text)
+        if sock:
+            sock.close()
+        return(False)
+    return(True)
+
+def _set_flags(sa, da, latency):
+    """Update status flags from result of probing address pair"""
+
+    global NPTv6, NAT44, NPTv6_tried, NAT44_tried, ULA_ok, GUA_ok, LLA_ok, IPv4_ok
+    global IPv6_tried, IPv4_tried
+
+    if sa.version == 6:
+        if ((sa.is_ula and da.is_ula) or (sa.is_ll and da.is_ll)
+                or (sa.is_global and da.is_global)):
+            IPv6_tried = True   #same class, so no translator involved
+        if sa.is_ula and not da.is_ula:
+            NPTv6_tried = True
+            if latency:
+                NPTv6 = True
+        elif latency:
+            if sa.is_ula and da.is_ula:
+                ULA_ok = True
+            elif sa.is_ll and da.is_ll:
+                LLA_ok = True
+            else:
+                GUA_ok = True
+    else:
+        if sa.is_priv == da.is_priv:
+            IPv4_tried = True   #same class, so no NAT involved
+        if sa.is_priv and not da.is_priv:
+            NAT44_tried = True
+            if latency:
                 NAT44 = True
+        if latency:
+            IPv4_ok = True
+
+def _pooled(sa, da):
+    """Check pooled connection for address pair.
+Return False if none or dead, its latency in ms if alive"""
+
+    key = (sa.text, da.text)
+    with _conn_pool_lock:
+        entry = _conn_pool.pop(key, None)  #nobody else can use it meanwhile
+    if not entry:
+        return(False)
+    if time.monotonic() - entry.last_used < _pool_idle:
+        try:
+            #nothing is ever sent, so a live connection has nothing to read
+            entry.sock.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            entry.last_used = time.monotonic()
+            with _conn_pool_lock:
+                _conn_pool[key] = entry
+            return(entry.latency)
+        except Exception as ex:
+            pass
+    #stale, closed by peer, or broken
+    entry.sock.close()
+    return(False)
+
+def _pool_put(sa, da, sock, latency):
+    """Keep connected probe socket for reuse, if there is room"""
+
+    with _conn_pool_lock:
+        if len(_conn_pool) < 2 * _max_da * max(len(_sa_list), 1):
+            try:
+                #let the stack notice if the path breaks while idle
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                if hasattr(socket, "TCP_KEEPIDLE"):
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 10)
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 2)
+            except Exception as ex:
+                pass
+            _conn_pool[(sa.text, da.text)] = _pool_entry(sock, latency)
+            sock = None
+    if sock:
         sock.close()
+
+def _prune_pool():
+    """Close pooled connections that are idle or due for a fresh measurement"""
+
+    now = time.monotonic()
+    with _conn_pool_lock:
+        for key in list(_conn_pool):
+            entry = _conn_pool[key]
+            if now - entry.last_used > _pool_idle or now - entry.opened > _pool_max_age:
+                del _conn_pool[key]
+                entry.sock.close()
+
+def _probe_http(sel, sock, sa, da, latency):
+    """Send HEAD request on newly connected probe socket.
+Return False if it could not be sent, True if reply awaited"""
+    try:
+        t0 = time.monotonic()
+        sock.send(b"HEAD / HTTP/1.0\r\n\r\n")
+        #keep the connect latency in case there is no reply
+        sel.register(sock, selectors.EVENT_READ, (sa, da, t0, latency))
     except Exception as ex:
-        #print("!connect", ex, sa, da)
         return(False)
-    return(latency)
-
-def _in_pair_list(sa, da, remove = False, latency = False):
+    return(True)
+
+def _reap(sel):
+    """Wait for probes registered with selector to complete.
+Return list of (sa, da, latency) with latency False if bad, in ms if OK"""
+
+    results = []
+    #all probes share one timeout, since they were all started together
+    deadline = time.monotonic() + _timeout
+    while sel.get_map():
+        wait = deadline - time.monotonic()
+        if wait <= 0:
+            break
+        for key, _ in sel.select(wait):
+            sock = key.fileobj
+            sa, da, t0, connected = key.data
+            sel.unregister(sock)
+            if connected:
+                #HEAD request was sent; time the first byte of reply
+                latency = connected
+                try:
+                    if sock.recv(1):
+                        latency = max(int((time.monotonic() - t0)*1000),1)
+                except Exception as ex:
+                    pass    #fall back to connect latency
+                sock.close()
+            elif sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                latency = False
+                sock.close()
+            else:
+                latency = max(int((time.monotonic() - t0)*1000),1)
+                if _probe_mode == "http":
+                    if _probe_http(sel, sock, sa, da, latency):
+                        continue    #result comes later
+                    sock.close()
+                else:
+                    _pool_put(sa, da, sock, latency)
+            _set_flags(sa, da, latency)
+            results.append((sa, da, latency))
+    #anything still pending has timed out
+    for key in list(sel.get_map().values()):
+        sel.unregister(key.fileobj)
+        key.fileobj.close()
+        sa, da, _, connected = key.data
+        _set_flags(sa, da, connected)
+        results.append((sa, da, connected))
+    return(results)
+
+def _wake_poll():
+    """Start the next polling pass now"""
+    global _work_pending
+    with _work_cv:
+        _work_pending = True
+        _work_cv.notify_all()
+
+def _in_pair_list(pm, sa, da, remove = False, latency = False):
     """Utility function for _poll"""
-    #called with pair list locked!
-    global _pair_list
-    for pr in _pair_list:
-        if sa == pr.sa and da == pr.da:
-            if remove:
-                _pair_list.remove(pr)
-            elif latency:
-                #fresh data, update rolling average
-                pr.latency = int((pr.latency + latency)/2)                 
-            return(pr)
+    #called with pair map locked, on a new copy of it!
+    #The copy is shallow, so the pairs themselves are still
+    #shared with readers and must be replaced, not changed.
+    k = (sa.text, da.text)
+    pr = pm.get(k)
+    if pr:
+        if remove:
+            del pm[k]
+        elif latency:
+            #fresh data, update rolling average
+            pr = _addr_pair(pr.sa_meta, pr.da_meta, int((pr.latency + latency)/2))
+            pm[k] = pr
+        return(pr)
     return False
 
     
@@ -391,149 +778,178 @@ class _poll(threading.Thread):
     """Poll SA/DA pairs"""
 ####################################################
 # This thread polls {SA, DA} pairs to see what     #
-# works and what doesn't.                          #
-# It grabs temporary copies of lists to reduce     #
-# waiting time for user calls.                     #
+# works and what doesn't, and does the monitoring  #
+# between passes.                                  #
+# It works on the current tuples of addresses, so  #
+# user calls never wait for it.                    #
 ####################################################
 
     def __init__(self):
         threading.Thread.__init__(self, daemon=True)
                 
     def run(self):
-        global _sa_list, _da_list, _pair_list, _poll_count
+        global _sa_list, _da_list, _pair_map, _pair_by_da, _poll_count, _work_pending
+        probed = set()  #destinations already probed at least once
+        #nothing to poll until the sources and targets are known
+        _getapr_ready.wait()
+        if _init_error:
+            return
+        #one selector (epoll on Linux) serves every pass;
+        #_reap() leaves it empty each time
+        sel = selectors.DefaultSelector()
         while True:    
-            _sa_list_lock.acquire()
-            sa_list = copy.copy(_sa_list)
-            _sa_list_lock.release()
-            for sa in sa_list:
-                remove_da_list = []
-                _da_list_lock.acquire()
-                da_list = copy.copy(_da_list)
-                _da_list_lock.release()
-                for da in da_list:
-                    #print("Polling",sa,_a)
-                    latency = _ok(sa, da) #NB this call can take 5 seconds to timeout
+            da_list = _da_list.values()
+            #skip an address family that has been tried but never
+            #worked, except every so often in case it comes back,
+            #and except for destinations never probed before
+            recheck = not _poll_count % _recheck
+            v6_useful = GUA_ok or ULA_ok or LLA_ok or NPTv6 or not IPv6_tried or recheck
+            v4_useful = IPv4_ok or NAT44 or not IPv4_tried or recheck
+            all_sa = _sa_list
+            sa_list = [sa for sa in all_sa
+                       if (v6_useful if sa.version == 6 else v4_useful)]
+
+            #start every probe at once, then collect the results,
+            #so one pass takes no longer than the slowest probe
+            results = []
+            for da in da_list:
+                for sa in (sa_list if da.text in probed else all_sa):
+                    #print("Polling",sa,da)
+                    latency = _pooled(sa, da)
+                    if latency:
+                        #still connected, no need for a new handshake
+                        results.append((sa, da, latency))
+                    elif not _submit(sel, sa, da):
+                        results.append((sa, da, False))
+            results += _reap(sel)
+            probed = {da.text for da in da_list}
+
+            #update the pair map in one go
+            with _pair_map_lock:
+                pm = dict(_pair_map)
+                for sa, da, latency in results:
                     if latency: 
                         #print("Poll OK")
-                        _pair_list_lock.acquire()
-                        if not _in_pair_list(sa, da, latency = latency):
-                            _pair_list.append(_addr_pair(sa, da, latency))
-                        _pair_list_lock.release()
+                        if not _in_pair_list(pm, sa, da, latency = latency):
+                            pm[(sa.text, da.text)] = _addr_pair(sa, da, latency)
                     else:
                         #print("Poll failed", sa, da)
-                        _pair_list_lock.acquire()
-                        _in_pair_list(sa, da, remove = True)
-                        _pair_list_lock.release()
-
-                        #Should it have worked, according to flags?
-                        #If so, remove destination to avoid future timeouts.
-                        #print("Failed:", sa, _da)
-                        if sa.version == 4 and da.version == 4:
-                            if sa.is_private and da.is_global and NAT44:
-                                remove_da_list.append(da)
-                            elif sa.is_global and da.is_global and IPv4_ok:
-                                remove_da_list.append(da)
-                        elif sa.version == 6 and da.version == 6:
-                            if sa.is_link_local and da.is_link_local and LLA_ok and sa.scope_id == da.scope_id:
-                                remove_da_list.append(da)
-                            elif _is_ula(sa) and _is_ula(da) and ULA_ok:
-                                remove_da_list.append(da)
-                            elif _is_ula(sa)and da.is_global and NPTv6 :
-                                remove_da_list.append(da)
-                            elif sa.is_global and da.is_global and GUA_ok:
-                                remove_da_list.append(da)
-                            
+                        _in_pair_list(pm, sa, da, remove = True)
+                by_da = {}
+                for pr in pm.values():
+                    by_da.setdefault(pr.da_meta.text, []).append(pr)
+                _pair_map = pm
+                _pair_by_da = by_da
+
+            remove_da_list = []
+            for sa, da, latency in results:
+                if not latency:
+                    #Should it have worked, according to flags?
+                    #If so, remove destination to avoid future timeouts.
+                    #print("Failed:", sa, _da)
+                    if sa.version == 4 and da.version == 4:
+                        if sa.is_priv and da.is_global and NAT44:
+                            remove_da_list.append(da)
+                        elif sa.is_global and da.is_global and IPv4_ok:
+                            remove_da_list.append(da)
+                    elif sa.version == 6 and da.version == 6:
+                        if sa.is_ll and da.is_ll and LLA_ok and sa.scope_id == da.scope_id:
+                            remove_da_list.append(da)
+                        elif sa.is_ula and da.is_ula and ULA_ok:
+                            remove_da_list.append(da)
+                        elif sa.is_ula and da.is_global and NPTv6 :
+                            remove_da_list.append(da)
+                        elif sa.is_global and da.is_global and GUA_ok:
+                            remove_da_list.append(da)
                     
-                if remove_da_list:
-                    #print("Removing destinations", remove_da_list)
-                    _da_list_lock.acquire()
-                    for  da in remove_da_list:
-                        if da in _da_list:
-                            _da_list.remove(da)
-                    _da_list_lock.release()
+            if remove_da_list:
+                #print("Removing destinations", remove_da_list)
+                with _da_list_lock:
+                    da_list = dict(_da_list)
+                    for da in remove_da_list:
+                        da_list.pop(da.text, None)
+                    _da_list = da_list
                     
+            _publish_status()
             _poll_count += 1
             if _poll_count > 1000:
                 _poll_count = 0
-        
-            time.sleep(10)
+            _first_poll_done.set()
 
-class _monitor(threading.Thread):
-    """Monitor progress"""
-####################################################
-# This thread monitors and logs progress           #
-####################################################
-
-    def __init__(self):
-        threading.Thread.__init__(self, daemon=True)
-                
-    def run(self):
-        global _sa_list, _da_list, _pair_list, _poll_count
-        global _sa_list_lock, _da_list_lock, _pair_list_lock
-        global _logging, _test_done
+            try:
+                _monitor_step()
+            except Exception as ex:
+                #don't let a bad moment stop the probing for good
+                _log("Monitoring failed:", ex)
         
-
-        while True:
-            time.sleep(10)
-            if _logging:
-                if _poll_count > 1:
-                    _log_lists()
-                _pair_list_lock.acquire()
-                _log("\nPair list:")
-                for _a in _pair_list:
-                    _log(str(_a.sa) +";"+ str(_a.da) +";"+ str(_a.latency))
-                _pair_list_lock.release()
-
-                _log("\nStatus:")
-                _log("GUA<>GUA:", GUA_ok, ", ULA<>ULA:", ULA_ok, ", LLA<>LLA:", LLA_ok, ", IPv4<>IPv4:", IPv4_ok)
-                _log("ULA:", ULA_present,", NPTv6:", NPTv6, ", RFC1918:", RFC1918, ", NAT44:", NAT44)
-                _log("Poll count:", _poll_count)
-            _logging = False
-
-            #Local hacks to test ULA testing...
-            
-##            if _poll_count >= 1 and not _test_done:
-##                _da_list_lock.acquire()
-##                _da_list += [ipaddress.IPv6Address("fd63:45eb:dc14:0:2e3a:fdff:fea4:dde7")]
-##                                                    #replace with a locally valid ULA
-##                #print("added dest", _da_list[-1])
+            #wait 10 seconds, or less if there is new work
+            with _work_cv:
+                _work_cv.wait_for(lambda: _work_pending, timeout=10)
+                _work_pending = False
+
+def _monitor_step():
+    """Monitor and log progress; run by _poll after each pass"""
+    global _da_list, _logging, _test_done
+
+    _prune_pool()
+    if _logging and _printing:
+        #(the pair list strings are built here, so check first)
+        if _poll_count > 1:
+            _log_lists()
+        _log("\nPair list:")
+        for _a in _pair_map.values():
+            _log(_a.sa_meta.text +";"+ _a.da_meta.text +";"+ str(_a.latency))
+
+        _log("\nStatus:")
+        _log("GUA<>GUA:", GUA_ok, ", ULA<>ULA:", ULA_ok, ", LLA<>LLA:", LLA_ok, ", IPv4<>IPv4:", IPv4_ok)
+        _log("ULA:", ULA_present,", NPTv6:", NPTv6, ", RFC1918:", RFC1918, ", NAT44:", NAT44)
+        _log("Poll count:", _poll_count)
+    _logging = False
+
+    #Local hacks to test ULA testing...
+    
+##    if _poll_count >= 1 and not _test_done:
+##        with _da_list_lock:
+##            _da_list = dict(_da_list)
+##            _a = _meta(ipaddress.IPv6Address("fd63:45eb:dc14:0:2e3a:fdff:fea4:dde7"))
+##                                                #replace with a locally valid ULA
+##            _da_list[_a.text] = _a
+##            #print("added dest", _a.text)
 ##
-####                #...and destination list purging.
-####                #If you uncomment this, there will be long delays
-####                #while pointlessly probing these addresses.
-####                _da_list += [ipaddress.IPv6Address("2001:db8:abcd:0101::abc1"),
-####                             ipaddress.IPv6Address("2001:db8:b123:0101::def2"),
-####                             ipaddress.IPv6Address("2001:db8:abcd:0101::abc2"),
-####                             ipaddress.IPv6Address("2001:db8:b123:0101::def3"),
-####                             ipaddress.IPv6Address("2001:db8:abcd:0101::abc3"),
-####                             ipaddress.IPv6Address("2001:db8:b123:0101::def4"),
-####                             ipaddress.IPv6Address("2001:db8:abcd:0101::abc4"),
-####                             ipaddress.IPv6Address("2001:db8:b123:0101::def5"),
-####                             ipaddress.IPv6Address("2001:db8:abcd:0101::abc5"),
-####                             ipaddress.IPv6Address("2001:db8:b123:0101::def6"),
-####                             ipaddress.IPv6Address("2001:db8:abcd:0101::abc6"),
-####                             ipaddress.IPv6Address("2001:db8:b123:0101::def7"),
-####                             ipaddress.IPv6Address("2001:db8:abcd:0101::abc7"),
-####                             ipaddress.IPv6Address("2001:db8:b123:0101::def8")]
+####            #...and destination list purging.
+####            #If you uncomment this, there will be long delays
+####            #while pointlessly probing these addresses.
+####            for _a in ("2001:db8:abcd:0101::abc1", "2001:db8:b123:0101::def2",
+####                       "2001:db8:abcd:0101::abc2", "2001:db8:b123:0101::def3",
+####                       "2001:db8:abcd:0101::abc3", "2001:db8:b123:0101::def4",
+####                       "2001:db8:abcd:0101::abc4", "2001:db8:b123:0101::def5",
+####                       "2001:db8:abcd:0101::abc5", "2001:db8:b123:0101::def6",
+####                       "2001:db8:abcd:0101::abc6", "2001:db8:b123:0101::def7",
+####                       "2001:db8:abcd:0101::abc7", "2001:db8:b123:0101::def8"):
+####                _a = _meta(ipaddress.IPv6Address(_a))
+####                _da_list[_a.text] = _a
 ##
-##                _da_list_lock.release()
-##                _test_done = True
-
-            if not _poll_count%6:
-                #regenerate source list
-                _update_sources()
-                #trim oldest entries in destination list
-                _da_list_lock.acquire()
-                while len(_da_list) > _max_da:
-                    for _da in _da_list:
-                        if not _da in (target6, target4, def_gateway6, def_gateway4):
-                            _da_list.remove(_da)
-                            break
-                _da_list_lock.release()                    
-                
+##        _test_done = True
+
+    if not _poll_count%6:
+        #regenerate source list
+        _update_sources()
+        #trim oldest entries in destination list
+        pins = {str(_a) for _a in (target6, target4, def_gateway6, def_gateway4) if _a}
+        with _da_list_lock:
+            da_list = dict(_da_list)
+            while len(da_list) > _max_da:
+                for _k in da_list:
+                    if not _k in pins:
+                        del da_list[_k]
+                        break
+                else:
+                    break   #nothing left but pinned addresses
+            _da_list = da_list
+        
 
-            if _poll_count < 3 or not _poll_count%10:
-                _logging = True
+    if _poll_count < 3 or not _poll_count%10:
+        _logging = True
 
 def get_addr_pairs(target, port, printing = False):
     """Get source and destination address pairs for the target host.
@@ -556,228 +972,312 @@ The port parameter is used only to build the appropriate DA tuple.
 The user is strongly recommended to try the address pairs in sequence.
 IPv6 addresses always come first if available.
 
+Until the first round of network probes is complete, this waits for
+it, for at most 15 seconds.
+
 The optional 'printing' parameter controls informational printing
 and is intended for debugging."""
     
-    global _da_list, _pair_list
-
-    if not _getapr_initialised:
-        init_getapr(printing = printing)
+    global _da_list, _printing
+
+    if printing:
+        _printing = True
+    if not _first_poll_done.is_set():
+        #until the first pass has validated an address family,
+        #no rule matches a global destination, so wait for it
+        deadline = time.monotonic() + _first_wait
+        _getapr_ready.wait(_first_wait)
+        if _init_error:
+            init_getapr(printing = printing)    #retry, or raise
+        _first_poll_done.wait(max(deadline - time.monotonic(), 0))
+    if not _sa_list:
+        #nothing useful can be said until the sources are known
+        _getapr_ready.wait()
+        if _init_error:
+            init_getapr(printing = printing)    #retry, or raise
     
     reply = []
     das = []
     if target:        #we do not handle a null host
 
         try:
-            das.append(ipaddress.ip_address(target))
+            das.append(_meta(_cached_ip(target)))
             #the user supplied an address
         except:         
             try:
-                ainf = socket.getaddrinfo(target, port)
-            except Exception as ex:
-                if 'getaddrinfo failed' in str(ex):
-                    return(reply)   #NXDOMAIN, so return nothing
-                else:
-                    raise(ex)       #something else, so re-raise it
-
-            #collate, ensuring IPv6 is always first
-            for item in ainf:
-                if item[0].name == 'AF_INET6':
-                    das.append(ipaddress.ip_address(item[4][0]))
-            for item in ainf:
-                if item[0].name == 'AF_INET':
-                    das.append(ipaddress.ip_address(item[4][0]))
+                ainf = _cached_getaddrinfo(target, port)
+            except socket.gaierror:
+                return(reply)   #NXDOMAIN etc., so return nothing
+
+            #collate in one pass, once per address (getaddrinfo
+            #lists each address per socket type); IPv6 is put
+            #first by the final sort
+            for _a in dict.fromkeys(item[4][0] for item in ainf):
+                das.append(_meta(_cached_ip(_a)))
                 
         #process list of destinations (if any)
         for da in das:
-            #is da already known?
+            #is da already known? (no lock needed to look)
             known_da = True
-            _da_list_lock.acquire()
-            if not da in _da_list:
-                _da_list.append(da)
-                known_da = False
-            _da_list_lock.release()
-            
-            #grab a copy of the pair list
-            _pair_list_lock.acquire()
-            pl = copy.copy(_pair_list) #!deepcopy fails on LLA
-            _pair_list_lock.release()
+            if not da.text in _da_list:
+                with _da_list_lock:
+                    if not da.text in _da_list:
+                        #still not there now that we hold the lock
+                        da_list = dict(_da_list)
+                        da_list[da.text] = da
+                        _da_list = da_list
+                        known_da = False
+            if not known_da:
+                _wake_poll()   #probe the new destination soon
 
             this_da_found = False
             if known_da:
                 #look for and suggest known pairs
-                for pair in pl:
-                    if pair.da == da:
-                        reply.append(pair)
-                        this_da_found = True
+                known = _pair_by_da.get(da.text, ())
+                if known:
+                    reply.extend(known)
+                    this_da_found = True
                        
             if not this_da_found:
-                #not yet in destination list, so check against flags
-                #and add if suitable
+                #no known pairs, so check against flags
                 
-                #first, grab a copy of the source list
-                _sa_list_lock.acquire()
-                sl = copy.copy(_sa_list) #!deepcopy fails on LLA
-                _sa_list_lock.release()
-
-                useful = False
+                #first, take the current source list
+                sl = _sa_list
                 if da.version == 6:
                     if da.is_global and GUA_ok:
                         #suggest GUA sources with default latency
                         for sa in sl:
                             if sa.version == 6 and sa.is_global:
                                 reply.append(_addr_pair(sa, da, _latency6))
-                                useful = True
-                    if _is_ula(da):
+                    if da.is_ula:
                         #suggest ULA sources with tuned latency
                         for sa in sl:
-                            if sa.version == 6 and _is_ula(sa):
+                            if sa.version == 6 and sa.is_ula:
                                 reply.append(_addr_pair(sa, da, _latency6-1))
-                                useful = True
                     if da.is_global and NPTv6:
                         #suggest ULA sources with translation and tuned latency
                         for sa in sl:
-                            if sa.version == 6 and _is_ula(sa):
+                            if sa.version == 6 and sa.is_ula:
                                 reply.append(_addr_pair(sa, da, _latency6+1))
-                                useful = True
-                    if da.is_link_local and LLA_ok:
+                    if da.is_ll and LLA_ok:
                         #suggest LLA sources with minimal latency
                         for sa in sl:
-                            if sa.version == 6 and sa.is_link_local and sa.scope_id == da.scope_id:
+                            if sa.version == 6 and sa.is_ll and sa.scope_id == da.scope_id:
                                 reply.append(_addr_pair(sa, da, 1)) 
-                                useful = True
                 if da.version == 4:
-                    if (da.is_global and NAT44) or da.is_private:
+                    if (da.is_global and NAT44) or da.is_priv:
                         #suggest RFC1918 sources with default latency
                         for sa in sl:
-                            if sa.version == 4 and sa.is_private:
+                            if sa.version == 4 and sa.is_priv:
                                 reply.append(_addr_pair(sa, da, _latency4))
-                                useful = True
                     elif da.is_global and IPv4_ok:
                         #suggest global IPv4 sources with default latency
                         for sa in sl:
                             if sa.version == 4 and sa.is_global:
                                 reply.append(_addr_pair(sa, da, _latency4))
-                                useful = True
-                    if da.is_link_local:
+                    if da.is_ll:
                         #suggest LLA sources with minimal latency +1
                         for sa in sl:
-                            if sa.version == 4 and sa.is_link_local:
+                            if sa.version == 4 and sa.is_ll:
                                 reply.append(_addr_pair(sa, da, 2)) 
-                                useful = True
-                if useful:
-                    #add to destination list
-                    _da_list_lock.acquire()
-                    _da_list.append(da)
-                    _da_list_lock.release()
 
     # sort replies on higher IP version and lower latency
     if reply:
-        reply.sort(key = lambda p: (-p.sa.version, p.latency))
+        reply.sort(key = lambda p: (-p.sa_meta.version, p.latency))
 
     # construct (AF, SA, DA) triples
     if reply:
         for i, pair in enumerate(reply):
-            if pair.sa.version == 6:
-                if pair.sa.is_link_local:    
+            if pair.sa_meta.version == 6:
+                if pair.sa_meta.is_ll:    
                     #must split interface index off
-                    da, zid = str(pair.da).split("%")
+                    da, zid = pair.da_meta.split
                     if os.name=="nt":
                         zid = eval(zid) #Windows: convert to numeric
                     else:
-                        zid = socket.if_nametoindex(zid) #POSIX: convert to numeric                   
+                        zid = _zid(zid) #POSIX: convert to numeric                   
                 else:
                     zid = 0
-                    da = pair.da
-                reply[i] = (socket.AF_INET6, (str(pair.sa),0,0,zid), (str(da), port, 0 ,zid))
+                    da = pair.da_meta.text
+                reply[i] = (socket.AF_INET6, (pair.sa_meta.text,0,0,zid), (da, port, 0 ,zid))
             else:
-                reply[i] = (socket.AF_INET, (str(pair.sa),0), (str(pair.da), port))
+                reply[i] = (socket.AF_INET, (pair.sa_meta.text,0), (pair.da_meta.text, port))
                 
     return(reply)
 
-def init_getapr(printing = False):
-    """Initialise data and threads for source address detection and
-destination probing.
-
-The optional 'printing' parameter controls informational printing
-and is intended for debugging.
-
-Initialisation takes at least 10 seconds and includes network probes."""
+def _anchor_addresses():
+    """Return lists of IPv6 and IPv4 addresses (as strings) of
+connected ATLAS anchors, from the disk cache if it is fresh enough.
+Either list may be empty if ATLAS cannot be reached."""
+    use_cache = os.path.isabs(_anchor_cache)   #else no home directory
+    try:
+        if not use_cache:
+            raise OSError
+        with open(_anchor_cache) as f:
+            if os.name != "nt" and os.fstat(f.fileno()).st_uid != os.getuid():
+                raise OSError   #somebody else's file, don't trust it
+            cache = json.load(f)
+        if time.time() - cache["time"] < _anchor_ttl and cache["v6"] and cache["v4"]:
+            return(cache["v6"], cache["v4"])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass    #no usable cache
+
+    v6 = []
+    v4 = []
+    try:
+        #one query for the whole filtered set; status 1 is 'Connected'
+        for _probe in itertools.islice(ProbeRequest(is_anchor=True, status=1,
+                                        page_size=_anchor_max), _anchor_max):
+            if _probe.get("address_v6"):
+                v6.append(_probe["address_v6"])
+            if _probe.get("address_v4"):
+                v4.append(_probe["address_v4"])
+    except Exception:
+        _log("Could not query ATLAS anchors")
+        
+    if v6 and v4 and use_cache:
+        try:
+            os.makedirs(os.path.dirname(_anchor_cache), mode=0o700, exist_ok=True)
+            #write then rename, so a reader never sees a partial file
+            with open(_anchor_cache+".tmp", "w") as f:
+                json.dump({"time": time.time(), "v6": v6, "v4": v4}, f)
+            os.replace(_anchor_cache+".tmp", _anchor_cache)
+        except OSError:
+            pass    #no cache next time, that's all
+    return(v6, v4)
+
+def _bg_init():
+    """Background initialisation, started when the module is imported"""
+    global _init_error
+    try:
+        _bg_setup()
+    except Exception as ex:
+        #init_getapr() will retry, and raise it if that fails too
+        _init_error = ex
+    finally:
+        #never leave callers waiting forever
+        _getapr_ready.set()
+
+def _retry_init():
+    """Repeat failed initialisation in the caller's thread;
+raise its exception if it fails again"""
+    global _init_error, _poll_thread
+    #the old _poll stops as soon as it sees the error, so wait
+    #for that before clearing it
+    _poll_thread.join()
+    _init_error = None
+    try:
+        _bg_setup()
+    except Exception as ex:
+        _init_error = ex
+        raise
+    #default stack size here, since changing it is process-wide
+    _poll_thread = _poll()
+    _poll_thread.start()
+
+def _bg_setup():
+    """Find sources and choose targets for _poll"""
     
-    global _logging, _printing, _prng, target6, target4, def_gateway6,def_gateway4
-    global _sa_list, _da_list, _pair_list, _poll_count, _getapr_initialised
-    global _sa_list_lock, _da_list_lock, _pair_list_lock
+    global _prng, target6, target4, _da_list
 
-    if _getapr_initialised:
-        return
-
-    _printing = printing
+    #sources first, since get_addr_pairs() may be waiting for them
+    _update_sources()
 
     #select a random pair of global probe targets
     #(ideally we'd repeat this every half hour to
     #spread the probes around the world)
 
-    _log("Choosing probe targets; may take a minute...")
+    _log("Choosing probe targets...")
     target6 = None
     target4 = None
-    for _i in range(1,10):
-        _tryp = _prng.randint(6000, 7200)
+    v6, v4 = _anchor_addresses()
+    #random order; a malformed entry just moves on to the next
+    _prng.shuffle(v6)
+    for _a in v6:
         try:
-            _probe = Probe(id=_tryp)
-            if _probe.is_anchor and _probe.status == 'Connected' and _probe.address_v6:
-                target6 = ipaddress.IPv6Address(_probe.address_v6)
-                break
-        except:
-            pass
-    for _i in range(1,10):
-        _tryp = _prng.randint(6000, 7200)
+            target6 = _cached_ipv6(_a)
+            break
+        except ValueError:
+            continue
+    _prng.shuffle(v4)
+    for _a in v4:
         try:
-            _probe = Probe(id=_tryp)
-            if _probe.is_anchor and _probe.status == 'Connected' and _probe.address_v4:
-                target4 = ipaddress.IPv4Address(_probe.address_v4)
-                break
-        except:
-            pass
+            target4 = _cached_ipv4(_a)
+            break
+        except ValueError:
+            continue
 
     #in case things are desparate...
     if not target6:
-        target6 = ipaddress.IPv6Address("2a00:dd80:3c::b3f") #ipv6.lookup.test-ipv6.com
+        target6 = _FALLBACK_V6
     if not target4:
-        target4 = ipaddress.IPv4Address("216.218.223.250") #ipv4.lookup.test-ipv6.com
+        target4 = _FALLBACK_V4
         
     _log("...chose", target6, "and", target4)
-     
-    _update_sources()
 
-    _da_list_lock.acquire()
-    _da_list.append(target6)
-    _da_list.append(target4)
-    if def_gateway6:
-        _da_list.append(def_gateway6)
-    if def_gateway4:
-        _da_list.append(def_gateway4)
-    _da_list_lock.release()
-
-    _log_lists()
-    _poll().start()
-    _monitor().start()
-    while _poll_count == 0:
-        #wait until first poll complete
-        time.sleep(1)
-    _getapr_initialised = True
+    with _da_list_lock:
+        da_list = dict(_da_list)
+        for _a in (target6, target4, def_gateway6, def_gateway4):
+            if _a:
+                _m = _meta(_a)
+                da_list[_m.text] = _m
+        _da_list = da_list
 
-    # Return from init_getapr; 2 threads continue indefinitely
+    # Return from _bg_setup; _poll starts polling when it sees _getapr_ready
 
-def status():
-    """Returns dictionary showing detected connectivity status."""
+def init_getapr(printing = False):
+    """Wait for initialisation of data and threads for source address
+detection and destination probing, which starts in the background
+when the module is imported.
 
-    return({"GUA_ok": GUA_ok, "ULA_ok": ULA_ok, "LLA_ok": LLA_ok, "IPv4_ok": IPv4_ok,
-     "ULA_present": ULA_present, "NPTv6": NPTv6, "RFC1918": RFC1918, "NAT44": NAT44})
+The optional 'printing' parameter controls informational printing
+and is intended for debugging.
 
+This waits until the first round of network probes is complete,
+which may take several seconds."""
+    
+    global _printing, _getapr_initialised
 
-                
+    if _getapr_initialised:
+        return      #fast path, no lock needed
+
+    with _init_lock:
+        if _getapr_initialised:
+            return  #another thread finished it while we waited
+        _printing = printing
+        _getapr_ready.wait()
+        if _init_error:
+            _retry_init()
+        _log("Probe targets are", target6, "and", target4)
+        _log_lists()
+        #wait until first poll complete
+        _first_poll_done.wait()
+        _getapr_initialised = True
+
+def status():
+    """Returns dictionary showing detected connectivity status."""
 
+    #a copy, so the caller may change it freely
+    return(dict(_status_dict))
 
 
+####################################################
+# Start initialisation in the background           #
+####################################################
 
-    
+threading.Thread(target=_bg_init, daemon=True).start()
+
+#_poll needs little stack, so don't reserve the default
+#(often 8 MB). The size is process-wide and applies to threads
+#started while it is set, so set it and restore it here in the
+#importing thread, around this one start.
+try:
+    _old_stack_size = threading.stack_size(_stack_size)
+except (ValueError, RuntimeError):
+    _old_stack_size = None  #not supported here
+try:
+    _poll_thread = _poll()
+    _poll_thread.start()
+finally:
+    if _old_stack_size is not None:
+        threading.stack_size(_old_stack_size)